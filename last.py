@@ -11,12 +11,25 @@ Usage:
 The -m option can be used to select the merging algorithm.
 The -g option selects the grouping method and the -o option
 selects the ordering. The -b option specifies the base directory.
+The -a option specifies a Last.fm API key; it may be given several
+times to spread the requests over several keys. The -l option limits
+the output to the given number of tracks. The -w option keeps running,
+updating the output whenever MP3 files are added to or removed from
+the input folders. The -r option refreshes ratings older than the
+given number of days, rewriting the output file as they are fetched;
+with -w, they are refreshed in the background.
 
     last.py in1.m3u in2.m3u > out.m3u
     last.py -m shuffle in1.m3u in2.m3u > out.m3u
     last.py -g dir in1.m3u in2.m3u > out.m3u
     last.py -o none in1.m3u in2.m3u > out.m3u
     last.py -b . in1.m3u in2.m3u > out.m3u
+    last.py -a key1 -a key2 in1.m3u in2.m3u > out.m3u
+    last.py -l 100 in1.m3u in2.m3u > out.m3u
+    last.py -w folder1 folder2 out.m3u
+    last.py -r 30 in.m3u out.m3u
+
+The script can also be imported as a module; see the Session class.
 
 To install, fetch the mutagen and bs4 libraries:
 
@@ -26,25 +39,46 @@ To install, fetch the mutagen and bs4 libraries:
 Then chmod +x and symlink to /usr/local/bin/last.py.
 """
 
+import array
+import contextlib
 import fnmatch
+import functools
 import getopt
+import heapq
+import itertools
 import multiprocessing
 import os
 import random
 import re
 import subprocess
 import sys
+import tempfile
+import threading
 import time
+import traceback
 import urllib
 
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from xml.sax.saxutils import escape, unescape
+
 # XML/HTML parsing
 import bs4
 
 # ID3 reading
 from mutagen.easyid3 import EasyID3
-from mutagen.id3 import ID3
+from mutagen.mp3 import MP3
+
+# directory watching (optional, Linux only)
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+API = ''    # insert key here, or several separated by commas
 
-API = ''    # insert key here
+XMLURL = 'http://ws.audioscrobbler.com/2.0/?' # Last.fm API
+HTMLURL = 'http://www.last.fm/music/'         # Last.fm track pages
 
 MERGE = ''  # merge function
 GROUP = ''  # group function
@@ -52,21 +86,232 @@ ORDER = ''  # sort function
 GFIRST = '' # group then sort
 BASE = ''   # base directory
 OUTPUT = '' # output file
+LIMIT = 0   # maximum number of tracks, 0 for no limit
+WATCH = ''  # keep the output up to date
+REFRESH = 0 # refresh ratings older than this many days, 0 for never
+
+WORKERS = 5 # number of concurrent requests
+RATE = 5    # requests per second per API key
+PASSES = 3  # number of passes over failed tracks
+JOBS = 8    # number of jobs processed at once, see Session.submit()
+SPARE = 0.2 # fraction of the request rate used for refreshing
+POLL = 60   # seconds between directory scans without inotify
+SETTLE = 2  # seconds to wait for directory changes to settle
+REWRITE = 60 # seconds between rewrites of the output while refreshing
+RATINGS = {} # rating function -> {track: rating}
+
+class Track(object):
+    """Metadata of a track."""
+    __slots__ = ('artist', 'title', 'album', 'albumartist', 'duration',
+                 'playcount', 'listeners', 'fetched')
+
+    def __init__(self, artist='', title='', album='', albumartist='',
+                 duration=-1, playcount=-1, listeners=-1, fetched=0):
+        self.artist = artist
+        self.title = title
+        self.album = album
+        self.albumartist = albumartist
+        self.duration = duration   # seconds, -1 if unknown
+        self.playcount = playcount # Last.fm playcount, -1 if unknown
+        self.listeners = listeners # Last.fm listeners, -1 if unknown
+        self.fetched = fetched     # time the ratings were fetched, 0 if unknown
+
+class Tracks:
+    """
+    Table of interned tracks.
+
+    Each path is assigned an integer ID, which is what the rest of
+    the pipeline passes around, so that grouping, merging and set
+    operations compare small integers rather than long strings.
+    Directory names are stored once and shared by all the tracks
+    in the directory, and metadata is read lazily, at most once
+    per track. Tracks may be added from several threads; callers
+    of adddir() and addfile() must hold the lock.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.dirs = []               # interned directory names
+        self.index = {}              # directory ID -> {file name: ID}
+        self.dirindex = {}           # directory name -> directory ID
+        self.dir = array.array('i')  # directory ID of each track
+        self.name = []               # file name of each track
+        self.meta = []               # metadata of each track
+
+    def add(self, path):
+        """Intern a path and return its track ID."""
+        dir, name = os.path.split(path)
+        with self.lock:
+            return self.addfile(self.adddir(dir), name)
+
+    def adddir(self, dir):
+        """Intern a directory name and return its directory ID."""
+        d = self.dirindex.get(dir)
+        if d is None:
+            d = len(self.dirs)
+            self.dirs.append(dir)
+            self.dirindex[dir] = d
+            self.index[d] = {}
+        return d
+
+    def addfile(self, d, name):
+        """Intern a file in directory D and return its track ID."""
+        names = self.index[d]
+        i = names.get(name)
+        if i is None:
+            i = len(self.name)
+            names[name] = i
+            self.dir.append(d)
+            self.name.append(name)
+            self.meta.append(None)
+        return i
+
+    def id(self, x):
+        """Return the track ID of a path or ID."""
+        return self.add(x) if isinstance(x, basestring) else x
+
+    def path(self, x):
+        """Return the path of a track ID or path."""
+        if isinstance(x, basestring):
+            return x
+        return os.path.join(self.dirs[self.dir[x]], self.name[x])
+
+    def settags(self, i, meta):
+        """Set the metadata of a track ID unless it is already known."""
+        with self.lock:
+            if self.meta[i] is None:
+                self.meta[i] = meta
+
+    def cached(self, x):
+        """Return the metadata of a track if it has been read."""
+        return self.meta[self.id(x)]
+
+    def forget(self, x):
+        """Forget the metadata and ratings of a track ID or path."""
+        i = self.id(x)
+        self.meta[i] = None
+        for ratings in RATINGS.values():
+            ratings.pop(i, None)
+
+    def tags(self, x):
+        """Return the metadata of a track ID or path."""
+        i = self.id(x)
+        meta = self.meta[i]
+        if meta is None:
+            # read the file outside the lock, but keep the metadata
+            # stored meanwhile, so that all callers get the same record
+            meta = Track(**id3(self.path(i)))
+            with self.lock:
+                if self.meta[i] is None:
+                    self.meta[i] = meta
+                meta = self.meta[i]
+        return meta
+
+    def __len__(self):
+        return len(self.name)
+
+TRACKS = Tracks()
 
 def load(path):
     """Load a playlist from disk."""
     if os.path.isdir(path):
-        xs = loaddirectory(path)
+        return loaddirectory(path)
     else:
-        dir = os.path.abspath(os.path.dirname(path))
-        file = open(path, 'rU')
-        try:
-            xs = [os.path.normpath(os.path.join(dir, line.strip()))
-                  for line in file if not re.match('^#', line)]
-        finally:
-            file.close()
+        return loadplaylist(path)
+
+def loadplaylist(path):
+    """
+    Load an M3U playlist from disk.
+    The file is read and split in one go. Relative paths
+    are resolved once per directory, and artist, title, duration
+    and ratings are taken from #EXTINF lines so that the MP3 files
+    need not be opened later on.
+    """
+    dir = os.path.abspath(os.path.dirname(path))
+    dirs = {} # directory in playlist -> directory ID
+    xs = []
+    info = None
+    lines = readfile(path).splitlines()
+    with TRACKS.lock:
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            if line[0] == '#':
+                if line.startswith('#EXTINF:'):
+                    info = parseextinf(line)
+                continue
+            sep = line.rfind('/') + 1
+            head = line[:sep]
+            d = dirs.get(head)
+            if d is None:
+                d = TRACKS.adddir(os.path.normpath(os.path.join(dir, head)))
+                dirs[head] = d
+            x = TRACKS.addfile(d, line[sep:])
+            if info:
+                TRACKS.settags(x, info)
+                info = None
+            xs.append(x)
     return xs
 
+def readfile(path):
+    """Read a file in one go, skipping any UTF-8 byte order mark."""
+    file = open(path, 'rb')
+    try:
+        str = file.read()
+    finally:
+        file.close()
+    if str.startswith('\xef\xbb\xbf'): # UTF-8 BOM
+        str = str[3:]
+    return str
+
+def parseextinf(line):
+    """
+    Parse an #EXTINF line into track metadata.
+    The artist and title are taken from the artist and title
+    attributes if present, otherwise from the name after the comma.
+    """
+    match = re.match(r'#EXTINF:\s*([-0-9.]+)((?:\s+[a-z]+="[^"]*")*)\s*,(.*)$',
+                     line)
+    if not match:
+        return None
+    info, attrs, name = match.groups()
+    attrs = dict((key, unescape(value, {'&quot;': '"'}))
+                 for key, value in re.findall('([a-z]+)="([^"]*)"', attrs))
+    artist, sep, title = name.partition(' - ')
+    artist = attrs.get('artist', artist if sep else '')
+    title = attrs.get('title', title if sep else '')
+    if not artist or not title:
+        return None
+    try:
+        duration = int(float(info))
+        playcount = int(attrs.get('playcount', -1))
+        listeners = int(attrs.get('listeners', -1))
+        fetched = int(attrs.get('fetched', 0))
+    except ValueError:
+        return None
+    return Track(artist=artist.strip(), title=title.strip(),
+                 duration=duration, playcount=playcount,
+                 listeners=listeners, fetched=fetched)
+
+def extinf(x):
+    """Return the #EXTINF line of a track, or '' if its tags are unread."""
+    meta = TRACKS.cached(x)
+    if not meta or not meta.artist or not meta.title:
+        return ''
+    attrs = ''
+    if meta.playcount >= 0:
+        attrs += ' playcount="%d"' % meta.playcount
+    if meta.listeners >= 0:
+        attrs += ' listeners="%d"' % meta.listeners
+    if attrs and meta.fetched > 0:
+        attrs += ' fetched="%d"' % meta.fetched
+    # the name may be ambiguous, e.g., if the artist contains " - "
+    artist = ' '.join(meta.artist.split())
+    title = ' '.join(meta.title.split())
+    for key, value in (('artist', artist), ('title', title)):
+        attrs += ' %s="%s"' % (key, escape(value, {'"': '&quot;'}))
+    return '#EXTINF:%d%s,%s - %s' % (meta.duration, attrs, artist, title)
+
 def loaddirectory(path):
     """Find all MP3 files in a directory."""
     files = []
@@ -75,40 +320,125 @@ def loaddirectory(path):
             path = os.path.join(root, filename)
             files.append(os.path.abspath(path))
     files.sort()
-    return files
+    return [TRACKS.add(x) for x in files]
 
 def tostring(xs):
     """Convert a playlist to a string."""
     return '\n'.join(xs)
 
-def write(xs, file=None, base=''):
-    """Write a playlist to file or standard output."""
-    if base:
-        xs = [os.path.relpath(x, base) for x in xs]
-    else:
-        xs = [os.path.abspath(x) for x in xs]
-    str = tostring(xs)
-    print(str)
+def write(xs, file=None, base='', quiet=False):
+    """
+    Write a playlist to file and standard output, unless QUIET is set,
+    and return it as a string.
+    The playlist is written in extended M3U format, with an #EXTINF line
+    for every track whose tags have been read, so that the output can be
+    fed back into last.py without reading the tags again.
+    """
+    lines = ['#EXTM3U']
+    for x in xs:
+        info = extinf(x)
+        if info:
+            lines.append(info)
+        path = TRACKS.path(x)
+        if base:
+            lines.append(os.path.relpath(path, base))
+        else:
+            lines.append(os.path.abspath(path))
+    str = tostring(lines)
+    if not quiet:
+        print(str)
     if file:
-        f = open(file, 'w')
+        writefile(file, str + '\n')
+    return str
+
+def writefile(path, str):
+    """Replace the contents of a file atomically."""
+    dir = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix='.last', dir=dir)
+    try:
+        f = os.fdopen(fd, 'w')
         try:
-            f.write(str + '\n')
+            f.write(str)
         finally:
             f.close()
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp, 0666 & ~umask)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path) # Windows cannot rename onto an existing file
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+def watch(paths, update, events=None):
+    """
+    Watch directories for added and removed MP3 files.
+    Whenever the files change, UPDATE is called with the sets of
+    added and removed track IDs and a dictionary mapping each
+    directory to its tracks, as loaddirectory() would return them.
+    EVENTS is an iterable yielding whenever the directories may have
+    changed; by default, see changes().
+    """
+    dirs = [path for path in paths if os.path.isdir(path)]
+    if not dirs:
+        return
+    snapshot = set(join(map(loaddirectory, dirs)))
+    for event in events if events is not None else changes(dirs):
+        listings = dict((dir, loaddirectory(dir)) for dir in dirs)
+        current = set(join(listings.values()))
+        added = current - snapshot
+        removed = snapshot - current
+        if added or removed:
+            update(added, removed, listings)
+        snapshot = current
+
+def changes(dirs):
+    """
+    Yield whenever the contents of the directories may have changed.
+    Uses inotify if pyinotify is installed, otherwise scans the
+    directories every POLL seconds.
+    """
+    if not pyinotify:
+        while True:
+            time.sleep(POLL)
+            yield
+    manager = pyinotify.WatchManager()
+    mask = (pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+            pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO |
+            pyinotify.IN_CLOSE_WRITE)
+    for dir in dirs:
+        manager.add_watch(dir, mask, rec=True, auto_add=True)
+    notifier = pyinotify.Notifier(manager, pyinotify.ProcessEvent())
+    try:
+        while True:
+            # block until something happens, then wait
+            # for the changes to settle
+            timeout = None
+            while notifier.check_events(timeout):
+                notifier.read_events()
+                notifier.process_events()
+                timeout = SETTLE * 1000
+            yield
+    finally:
+        notifier.stop()
 
 def timeout(fn, *args, **kwargs):
-    """Call a function with a timeout."""
+    """
+    Call a function with a timeout.
+    The function is called in a child process, forked anew for each
+    call, which is killed if it takes more than TIME seconds.
+    """
     result = kwargs.get('fail', -1)
     retry = kwargs.get('retry', 5)
     time = kwargs.get('time', 30)
-    pool = multiprocessing.Pool(1, maxtasksperchild=1)
     while retry > 0:
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
         try:
-            result = pool.apply_async(fn, args)
-            result = result.get(timeout=time)
+            result = pool.apply_async(fn, args).get(timeout=time)
             retry = 0
         except multiprocessing.TimeoutError:
-            retry =- 1
+            retry -= 1
         finally:
             pool.terminate()
     return result
@@ -118,18 +448,28 @@ def id3(path):
     def utf8(str):
         return unicode(str).encode('utf-8').strip()
     meta = {'artist': '', 'title': '', 'album': '', 'albumartist' : ''}
+    duration = -1
+    try:
+        audio = MP3(path, ID3=EasyID3)
+        duration = int(audio.info.length)
+        tags = audio.tags or {}
+    except:
+        # no MPEG frames found, so no duration: read the tags alone
+        try:
+            tags = EasyID3(path)
+        except:
+            tags = {}
     try:
-        tags = EasyID3(path)
-        tags2 = ID3(path)
         meta['artist'] = tags.get('artist', [''])[0]
         meta['title'] = tags.get('title', [''])[0]
         meta['album'] = tags.get('album', [''])[0]
-        meta['albumartist'] = tags2.get('TPE2', [''])[0]
+        meta['albumartist'] = tags.get('albumartist', [''])[0]
         meta = {key: utf8(meta[key]) for key in meta}
         meta['artist'] = meta['artist'] or meta['albumartist']
         meta['albumartist'] = meta['albumartist'] or meta['artist']
     except:
         pass
+    meta['duration'] = duration
     return meta
 
 def subrange(xs):
@@ -159,6 +499,244 @@ class Memoize:
             self.memo[args] = self.fn(*args)
         return self.memo[args]
 
+class RateLimiter:
+    """Thread-safe token bucket rate limiter."""
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate) # tokens per second
+        self.burst = burst      # maximum number of tokens
+        self.tokens = burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        """Add the tokens accumulated since the last call."""
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def available(self):
+        """Return the number of tokens available."""
+        with self.lock:
+            self.refill()
+            return self.tokens
+
+    def reserve(self):
+        """Take a token and return the time to wait for it."""
+        with self.lock:
+            self.refill()
+            self.tokens -= 1
+            return -self.tokens / self.rate
+
+    def wait(self):
+        """Block until a request may be made."""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def setrate(self, rate, drain=False):
+        """Change the rate, optionally dropping the saved-up tokens."""
+        with self.lock:
+            self.refill()
+            self.rate = float(rate)
+            if drain:
+                self.tokens = min(self.tokens, 0)
+
+class Unavailable(Exception):
+    """Last.fm failed temporarily; the request may be retried later."""
+
+class Throttled(Unavailable):
+    """Last.fm rejected a request for exceeding the rate limit."""
+
+class InvalidKey(Unavailable):
+    """Last.fm rejected the API key."""
+
+class Cancelled(Exception):
+    """A job was cancelled or ran out of time."""
+
+class Controller:
+    """
+    Adaptive request controller.
+    The rate of the limiter is halved whenever Last.fm throttles us,
+    and creeps back up to the nominal rate as requests succeed.
+    After a number of consecutive failures, the circuit opens and
+    no requests are made until the cooldown period has passed;
+    a failure after that opens the circuit again.
+    """
+    def __init__(self, limiter, threshold=5, cooldown=60):
+        self.limiter = limiter
+        self.nominal = limiter.rate  # rate to return to
+        self.minimum = limiter.rate / 20
+        self.threshold = threshold   # failures before opening
+        self.cooldown = cooldown     # seconds to stay open
+        self.failures = 0            # consecutive failures
+        self.opened = 0              # time the circuit opened
+        self.lock = threading.Lock()
+
+    def closed(self):
+        """Whether requests may be made."""
+        with self.lock:
+            return self.remaining() <= 0
+
+    def remaining(self):
+        """Seconds until the circuit closes."""
+        if self.failures < self.threshold:
+            return 0
+        return self.opened + self.cooldown - time.time()
+
+    def success(self):
+        """Register a successful request."""
+        with self.lock:
+            self.failures = 0
+            rate = self.limiter.rate
+            if rate < self.nominal:
+                self.limiter.setrate(min(self.nominal,
+                                         rate + self.nominal / 20))
+
+    def failure(self, throttled=False):
+        """Register a failed request."""
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = time.time()
+            if throttled:
+                self.limiter.setrate(max(self.minimum,
+                                         self.limiter.rate / 2), True)
+
+class KeyPool:
+    """
+    Pool of API keys.
+    Each key has its own rate limiter and controller, so the total
+    request rate grows with the number of keys while each key stays
+    within its own budget. The controllers are shared by all pools
+    holding the key (see controller()), so a key never exceeds its
+    budget, whichever pools it is used in. Requests go to the healthy
+    key with the most tokens available. A key rejected by Last.fm is
+    dropped; once all keys are dropped, the webpages are scraped
+    instead.
+    """
+    def __init__(self, keys, rate=RATE):
+        self.keys = list(keys)
+        self.controllers = dict((key, controller(key, rate))
+                                for key in self.keys + [''])
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait for a key to become available and return it. The wait is
+        cut short if the job of the thread is stopped meanwhile.
+        """
+        with self.lock:
+            keys = [key for key in self.keys
+                    if self.controllers[key].closed()]
+            if not keys:
+                raise Unavailable('no API key available')
+            key = max(keys, key=self.available)
+            delay = self.controllers[key].limiter.reserve()
+        if delay > 0:
+            pause(delay)
+        return key
+
+    def available(self, key):
+        """Return the number of tokens available for a key."""
+        return self.controllers[key].limiter.available()
+
+    def controller(self, key):
+        """Return the controller of a key."""
+        return self.controllers[key]
+
+    def remove(self, key):
+        """Drop a key from the pool."""
+        with self.lock:
+            if key not in self.keys:
+                return
+            self.keys.remove(key)
+            if self.keys:
+                return
+            self.keys.append('') # scrape the webpages
+        sys.stderr.write('Warning: Last.fm rejected all API keys, '
+                         'scraping the webpages instead\n')
+
+    def remaining(self):
+        """Seconds until a key becomes available."""
+        with self.lock:
+            times = [self.controllers[key].remaining() for key in self.keys]
+        return min(times) if times else 0
+
+    def rate(self):
+        """Return the total request rate."""
+        with self.lock:
+            return sum(self.controllers[key].limiter.rate
+                       for key in self.keys)
+
+LOCAL = threading.local() # session and job of the current thread
+
+def current():
+    """Return the session of the current thread, or None."""
+    return getattr(LOCAL, 'session', None)
+
+def currentjob():
+    """Return the job of the current thread, or None."""
+    return getattr(LOCAL, 'job', None)
+
+def pause(seconds):
+    """Sleep for SECONDS, waking up once the job of the thread is stopped."""
+    job = currentjob()
+    if job:
+        job.wait(seconds)
+    else:
+        time.sleep(seconds)
+
+@contextlib.contextmanager
+def using(session, job=None):
+    """
+    Make SESSION the session of the current thread, and JOB its job.
+    If JOB is not given, the job of the thread is kept.
+    """
+    outer = current(), currentjob()
+    LOCAL.session = session
+    LOCAL.job = job or outer[1]
+    try:
+        yield session
+    finally:
+        LOCAL.session, LOCAL.job = outer
+
+KEYS = {} # API keys -> pool of API keys, see keypool()
+CONTROLLERS = {} # API key -> controller of its requests
+KEYSLOCK = threading.RLock()
+
+def controller(key, rate=RATE):
+    """Return the controller of an API key, creating it on first use."""
+    with KEYSLOCK:
+        result = CONTROLLERS.get(key)
+        if result is None:
+            # don't make more than 5 requests per second per key
+            # (averaged over a 5 minute period)
+            result = CONTROLLERS[key] = Controller(RateLimiter(rate, rate))
+        return result
+
+def apikeys():
+    """
+    Return the API keys of the current session, or those in API,
+    or [''] to scrape webpages instead.
+    """
+    session = current()
+    api = session.api if session else API
+    return [key.strip() for key in api.split(',') if key.strip()] or ['']
+
+def keypool():
+    """
+    Return the pool of the API keys in use, creating it on first use.
+    Sessions using the same keys, in whatever order, share the same
+    pool; sessions sharing only some keys share their budgets.
+    """
+    keys = tuple(sorted(set(apikeys())))
+    with KEYSLOCK:
+        pool = KEYS.get(keys)
+        if pool is None:
+            pool = KEYS[keys] = KeyPool(keys, RATE)
+        return pool
+
 class RandomGenerator:
     """Fair random generator."""
     def __init__(self):
@@ -211,12 +789,13 @@ class RandomGenerator:
         if x in self.history:
             self.history[self.history.index(x)] = y
 
-def performmerge(xss, window, pick, rand=False, fair=True):
+def performmerge(xss, window, pick, rand=False, fair=True, limit=0):
     """Merge tracks from playlists by interleaving or random choice."""
     rand = RandomGenerator() if rand == True else rand
+    xss = [deque(xs) for xs in xss]
     q = []
     result = []
-    while q or xss:
+    while (q or xss) and (limit <= 0 or len(result) < limit):
         # remove empty tracks from q
         r = []
         for xs, c in q:
@@ -242,19 +821,18 @@ def performmerge(xss, window, pick, rand=False, fair=True):
         # add track to result
         if q and rand:
             xs = rand.choice(fair)
-            x = xs.pop(0)
+            x = xs.popleft()
             result.append(x)
-            q = [(lst, c + 1 if lst == xs else c) for lst, c in q]
+            q = [(lst, c + 1 if lst is xs else c) for lst, c in q]
         else:
             if fair:
                 beg, end = subrange([c for xs, c in q])
-                chosen = q[beg:end]
             else:
-                chosen = q
+                beg, end = 0, len(q)
             r = []
-            for xs, c in q:
-                if (xs, c) in chosen:
-                    x = xs.pop(0)
+            for i, (xs, c) in enumerate(q):
+                if beg <= i < end and (limit <= 0 or len(result) < limit):
+                    x = xs.popleft()
                     result.append(x)
                     r.append((xs, c + 1))
                 else:
@@ -262,58 +840,295 @@ def performmerge(xss, window, pick, rand=False, fair=True):
             q = r
     return result
 
+def truncate(xs, limit=0):
+    """Keep the first LIMIT tracks of a playlist, if LIMIT > 0."""
+    return xs[:limit] if limit > 0 else xs
+
 def performgroup(xs, key=None):
     """Group a playlist into several."""
-    dict = [] # use a list to preserve order
+    groups = [] # use a list to preserve order
+    index = {}  # key -> position in groups
     keyfn = key if key else lambda x: 0
     for x in deletedup(xs):
         key = keyfn(x)
-        for k, xs in dict:
-            if k == key:
-                xs.append(x)
-                break
+        if key in index:
+            groups[index[key]].append(x)
         else:
-            dict.append((key, [x]))
-    return [xs for k, xs in dict]
+            index[key] = len(groups)
+            groups.append([x])
+    return groups
 
 def deletedup(xs):
     """Delete duplicates in a playlist."""
+    seen = set()
     result = []
     for x in xs:
-        if x not in result:
+        if x not in seen:
+            seen.add(x)
             result.append(x)
     return result
 
 def deletedups(xss):
     """Delete duplicates in playlists."""
     xss = map(deletedup, xss)
-    i = 0
-    for xs in xss[1:]:
-        for x in xss[i]:
-            if x in xs: xs.remove(x)
-        i += 1
+    prev = set()
+    for i, xs in enumerate(xss):
+        xss[i] = [x for x in xs if x not in prev]
+        prev = set(xss[i])
     return [xs for xs in xss if xs]
 
-def sort(xs, fn):
-    """Sort tracks by rating."""
-    total = len(xs)
-    num = 1
-    result = []
-    for x in xs:
-        tags = id3(x)
-        rating = timeout(fn, x)
-        rating = rating if rating >= 0 else 0
-        result.append((x, rating))
+def sort(xs, fn, limit=0):
+    """Sort tracks by rating, keeping the LIMIT best if LIMIT > 0."""
+    if limit > 0:
+        return select(xs, fn, limit, bounds.get(fn))
+    ratings = prefetch(xs, fn)
+    return sorted(xs, key=lambda x: ratings.get(x, 0), reverse=True)
+
+def select(xs, fn, n, bound=None):
+    """
+    Select the N best tracks by rating, without duplicates.
+    BOUND is a function returning an upper bound of a track's rating,
+    e.g., the rating of its artist. If given, the bounds are fetched
+    first, and the tracks are rated in order of decreasing bound until
+    the Nth best rating exceeds the bound of the next track. The rest
+    cannot make the cut, so their ratings are never fetched. Tracks
+    that could not be rated are rated 0.
+    """
+    xs = deletedup(xs)
+    if not bound:
+        ratings = prefetch(xs, fn)
+        return heapq.nlargest(n, xs, key=lambda x: ratings.get(x, 0))
+    limits = prefetch(xs, bound, True)
+    limit = lambda x: limits.get(x, sys.maxint)
+    ys = sorted(xs, key=limit, reverse=True)
+    ratings = RATINGS.setdefault(fn, {})
+    rating = lambda x: ratings.get(x, 0)
+    batch = max(1, WORKERS * len(keypool().keys)) # keys may be dropped
+    top = [] # heap of the N best ratings so far
+    i = 0
+    while i < len(ys):
+        if len(top) >= n and top[0] > limit(ys[i]):
+            break
+        prefetch(ys[i:i + batch], fn)
+        for x in ys[i:i + batch]:
+            if len(top) < n:
+                heapq.heappush(top, rating(x))
+            elif rating(x) > top[0]:
+                heapq.heapreplace(top, rating(x))
+        i += batch
+    rated = set(ys[:i])
+    xs = [x for x in xs if x in rated]
+    return heapq.nlargest(n, xs, key=rating)
+
+def prefetch(xs, fn, quiet=False):
+    """
+    Rate tracks concurrently.
+    Tracks are first grouped on artist and title, so that each song
+    is rated once per rating function even if it occurs several times,
+    in several playlists or under several paths. The rating of a song
+    is then copied to all of its tracks. Requests are spread over
+    WORKERS threads per API key. Songs that could not
+    be rated because Last.fm was unavailable are put back in the
+    queue and retried in a later pass, up to PASSES passes, after
+    which they are left out of the returned ratings, so that they
+    are fetched again next time. Progress is printed unless QUIET is set
+    or the session is quiet. If the job of the thread is cancelled,
+    no further requests are made and Cancelled is raised.
+    """
+    ratings = RATINGS.setdefault(fn, {})
+    xs = [x for x in deletedup(xs) if x not in ratings]
+    if not xs:
+        return ratings
+    session = current()
+    job = currentjob()
+    quiet = quiet or (session and session.quiet)
+    def rate(xs):
+        if job and job.stopped():
+            return xs, None
+        try:
+            with using(session, job):
+                rating = fn(xs[0])
+        except Unavailable:
+            return xs, None
+        share(xs)
+        return xs, rating if rating >= 0 else 0
+    def record(xs, rating):
+        if rating is not None:
+            for x in xs:
+                ratings[x] = rating
+        if quiet:
+            return
+        tags = TRACKS.tags(xs[0])
         print('#%s/%s:\t%s\t%s - %s' %
               (str(num).zfill(len(str(total))),
-               total, rating, tags['artist'], tags['title']))
-        # don't make more than 5 requests per second
-        # (averaged over a 5 minute period)
-        if num % 100 == 0:
-            time.sleep(10)
-        num += 1
-    result = sorted(result, key=lambda x: x[1], reverse=True)
-    return [x for x, c in result]
+               total, rating or 0, tags.artist, tags.title))
+    workers = WORKERS * len(keypool().keys)
+    pool = ThreadPool(max(1, min(workers, len(xs))))
+    try:
+        xss = plan(xs, pool)
+        total = len(xss)
+        num = 1
+        for n in range(PASSES):
+            if n > 0:
+                pause(max(0, keypool().remaining()))
+                if job and job.stopped():
+                    raise Cancelled()
+            failed = []
+            for xs, rating in pool.imap_unordered(rate, xss):
+                if job and job.stopped():
+                    raise Cancelled()
+                if rating is None:
+                    failed.append(xs)
+                    continue
+                record(xs, rating)
+                num += 1
+            xss = failed
+            if not xss:
+                break
+        for xs in xss:
+            record(xs, None)
+            num += 1
+    finally:
+        pool.terminate()
+    return ratings
+
+def plan(xs, pool=None):
+    """
+    Group tracks on artist and title.
+    The first track of each group is the one to fetch; a track
+    whose ratings are already known is preferred.
+    """
+    if pool:
+        pool.map(TRACKS.tags, xs) # read the tags concurrently
+    def song(x):
+        tags = TRACKS.tags(x)
+        if not tags.artist or not tags.title:
+            return x # untagged tracks are never the same song
+        return (tags.artist.lower(), tags.title.lower())
+    def known(x):
+        tags = TRACKS.tags(x)
+        return tags.playcount >= 0 or tags.listeners >= 0
+    xss = performgroup(xs, song)
+    return [sorted(xs, key=known, reverse=True) for xs in xss]
+
+def share(xs):
+    """Copy the ratings of the first track to the other tracks."""
+    first = TRACKS.tags(xs[0])
+    for x in xs[1:]:
+        tags = TRACKS.tags(x)
+        if tags.playcount < 0:
+            tags.playcount = first.playcount
+        if tags.listeners < 0:
+            tags.listeners = first.listeners
+        tags.fetched = max(tags.fetched, first.fetched)
+
+class Refresher(threading.Thread):
+    """
+    Background refresher of stale ratings.
+    Known ratings are used as they are, however old, while this thread
+    fetches the ratings older than MAXAGE seconds anew: the stalest
+    first and, among equally stale ones, the most played first.
+    It only uses a SPARE fraction of the request rate, so the requests
+    of the pipeline are hardly slowed down. The refreshed ratings are
+    stored in the tracks' metadata and the ratings derived from them
+    are dropped, so that they are computed again on next use. DONE is
+    called at the end if any rating changed. LOCK, if given, is held
+    while the ratings are replaced; the pipeline must hold it too,
+    lest a rating it has just fetched be dropped before it is used.
+    Songs are refreshed by WORKERS threads, and the number of songs
+    whose ratings changed so far is kept in CHANGED.
+    """
+    def __init__(self, xs, maxage, done=None, spare=SPARE, lock=None,
+                 workers=1):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.xs = list(xs)
+        self.maxage = maxage
+        self.done = done
+        self.spare = spare
+        self.lock = lock or threading.Lock()
+        self.workers = workers
+        self.limiter = RateLimiter(1)
+        self.stopped = threading.Event()
+        self.session = current()
+        self.changed = 0
+
+    def stale(self):
+        """Return the songs to refresh, most urgent first."""
+        deadline = time.time() - self.maxage
+        def stale(xs):
+            tags = TRACKS.tags(xs[0])
+            return ((tags.playcount >= 0 or tags.listeners >= 0) and
+                    tags.fetched < deadline)
+        def urgency(xs):
+            tags = TRACKS.tags(xs[0])
+            return (tags.fetched, -tags.playcount)
+        return sorted(filter(stale, plan(self.xs)), key=urgency)
+
+    def pace(self):
+        """Wait for a spare request."""
+        rate = keypool().rate() * self.spare
+        if rate <= 0:
+            raise Unavailable('no API key available')
+        self.limiter.setrate(rate)
+        self.limiter.wait()
+
+    def refresh(self, xs):
+        """Refresh the ratings of a song and return whether they changed."""
+        tags = TRACKS.tags(xs[0])
+        new = {} # listeners -> rating
+        for listeners in (False, True):
+            old = tags.listeners if listeners else tags.playcount
+            if old < 0:
+                continue
+            self.pace()
+            rating = lastfmrequest(lastfmxml, lastfmhtml,
+                                   tags.artist, tags.title, listeners)
+            if rating >= 0 and rating != old:
+                new[listeners] = rating
+        now = int(time.time())
+        with self.lock:
+            for listeners, rating in new.items():
+                lastfmfetch.memo[(tags.artist, tags.title, listeners)] = rating
+            for x in xs:
+                meta = TRACKS.tags(x)
+                meta.playcount = new.get(False, meta.playcount)
+                meta.listeners = new.get(True, meta.listeners)
+                meta.fetched = now
+                if new:
+                    for ratings in RATINGS.values():
+                        ratings.pop(x, None)
+        return bool(new)
+
+    def run(self):
+        with using(self.session):
+            self.refreshall()
+
+    def refreshall(self):
+        """Refresh the stale songs, calling DONE if any rating changed."""
+        def attempt(xs):
+            if self.stopped.is_set():
+                return False
+            try:
+                with using(self.session):
+                    return self.refresh(xs)
+            except Unavailable:
+                # leave the song stale and wait for the circuit to close
+                self.stopped.wait(max(0, keypool().remaining()))
+                return False
+        pool = ThreadPool(self.workers)
+        try:
+            for changed in pool.imap_unordered(attempt, self.stale()):
+                if changed:
+                    self.changed += 1
+        finally:
+            pool.terminate()
+        if self.changed and self.done:
+            self.done()
+
+    def stop(self):
+        """Stop refreshing after the current song."""
+        self.stopped.set()
 
 # Scraping functions
 
@@ -321,19 +1136,41 @@ def sort(xs, fn):
 def lastfmxml(artist, title, listeners=False, correct=True, api=''):
     """Fetch a track's Last.fm playcount."""
     if not artist or not title: return -1
+    return lastfmapi([('method', 'track.getInfo'),
+                      ('artist', artist),
+                      ('track',  title)],
+                     listeners, correct, api)
+
+def lastfmartistxml(artist, listeners=False, correct=True, api=''):
+    """Fetch an artist's Last.fm playcount."""
+    if not artist: return -1
+    return lastfmapi([('method', 'artist.getInfo'),
+                      ('artist', artist)],
+                     listeners, correct, api)
+
+def lastfmapi(params, listeners=False, correct=True, api=''):
+    """Make a Last.fm API request and return the playcount."""
     rating = 0
-    api = API if not api else api
+    api = apikeys()[0] if not api else api
     correct = 1 if correct else 0
-    url = 'http://ws.audioscrobbler.com/2.0/?'
-    url += urllib.urlencode([('method',      'track.getInfo'),
-                             ('api_key',     api),
-                             ('artist',      artist),
-                             ('track',       title),
-                             ('autocorrect', correct)])
+    url = XMLURL
+    url += urllib.urlencode(params + [('api_key',     api),
+                                      ('autocorrect', correct)])
     try:
         file = urllib.urlopen(url)
         try:
+            httperror(file.getcode())
             soup = bs4.BeautifulSoup(file)
+            error = soup.find('error')
+            if error:
+                code = error.get('code', '')
+                if code == '29':
+                    raise Throttled('Last.fm error %s' % code)
+                if code in ('10', '26'):
+                    raise InvalidKey('Last.fm error %s' % code)
+                if code in ('8', '11', '16'):
+                    raise Unavailable('Last.fm error %s' % code)
+                return -1
             if listeners:
                 node = soup.find('listeners')
             else:
@@ -344,8 +1181,8 @@ def lastfmxml(artist, title, listeners=False, correct=True, api=''):
             rating = int(txt)
         finally:
             file.close()
-    except IOError:
-        return -1
+    except IOError as e:
+        raise Unavailable(str(e))
     return rating
 
 # fall-back: scrape the playcount off the track's webpage
@@ -353,11 +1190,12 @@ def lastfmhtml(artist, title, listeners=False):
     """Scrape a track's Last.fm playcount."""
     if not artist or not title: return -1
     rating = 0
-    url = ('http://www.last.fm/music/%s/_/%s' %
-           (urllib.quote_plus(artist), urllib.quote_plus(title)))
+    url = HTMLURL + ('%s/_/%s' %
+                     (urllib.quote_plus(artist), urllib.quote_plus(title)))
     try:
         file = urllib.urlopen(url)
         try:
+            httperror(file.getcode())
             soup = bs4.BeautifulSoup(file)
             if listeners:
                 node = soup.find('li', 'listeners')
@@ -373,23 +1211,108 @@ def lastfmhtml(artist, title, listeners=False):
             rating = int(txt)
         finally:
             file.close()
-    except IOError:
+    except IOError as e:
+        raise Unavailable(str(e))
+    return rating
+
+def httperror(status):
+    """Raise an exception for a temporary HTTP error."""
+    if status == 429:
+        raise Throttled('HTTP error %s' % status)
+    if status >= 500:
+        raise Unavailable('HTTP error %s' % status)
+
+def lastfmfetch(artist, title, listeners=False):
+    """Fetch a track's Last.fm rating."""
+    return lastfmrequest(lastfmxml, lastfmhtml, artist, title, listeners)
+
+def lastfmartistfetch(artist, listeners=False):
+    """Fetch an artist's Last.fm rating (only with an API key)."""
+    return lastfmrequest(lastfmartistxml, None, artist, listeners)
+
+def lastfmrequest(xml, html, *args):
+    """
+    Make a Last.fm request in a child process.
+    The request is made by calling XML with the next available API
+    key, or by calling HTML to scrape the webpage if there is none.
+    Raises Unavailable without making a request if the circuits of
+    all keys are open. Failures are not cached, so the request may
+    be made again later. Raises Cancelled if the job of the thread
+    was cancelled while waiting for a key.
+    """
+    pool = keypool()
+    if not html and pool.keys == ['']:
         return -1
+    key = pool.acquire()
+    job = currentjob()
+    if job and job.stopped():
+        raise Cancelled()
+    controller = pool.controller(key)
+    try:
+        if key:
+            rating = timeout(xml, *(args + (True, key)),
+                             fail=None, retry=1)
+        else:
+            rating = timeout(html, *args, fail=None, retry=1)
+        if rating is None:
+            raise Unavailable('timed out')
+    except InvalidKey:
+        pool.remove(key)
+        raise
+    except Throttled:
+        controller.failure(True)
+        raise
+    except Unavailable:
+        controller.failure()
+        raise
+    controller.success()
     return rating
 
 # Cache functions
-lastfmxml = Memoize(lastfmxml)
-lastfmhtml = Memoize(lastfmhtml)
+lastfmfetch = Memoize(lastfmfetch)
+lastfmartistfetch = Memoize(lastfmartistfetch)
 
 def lastfmrating(track, listeners=False):
     """Return the Last.fm rating for a track."""
-    tags = id3(track)
-    rating = lastfmxml if API else lastfmhtml
-    return rating(tags['artist'], tags['title'], listeners)
+    tags = TRACKS.tags(track)
+    rating = tags.listeners if listeners else tags.playcount
+    if rating < 0:
+        rating = lastfmfetch(tags.artist, tags.title, listeners)
+        if rating >= 0 and listeners:
+            tags.listeners = rating
+        elif rating >= 0:
+            tags.playcount = rating
+        if rating >= 0 and not tags.fetched:
+            tags.fetched = int(time.time())
+    return rating
+
+def lastfmbound(track, listeners=False):
+    """
+    Return an upper bound of the Last.fm rating of a track:
+    the rating itself if it is known, otherwise the rating of the
+    artist. If neither is available, there is no bound.
+    """
+    tags = TRACKS.tags(track)
+    rating = tags.listeners if listeners else tags.playcount
+    if rating >= 0:
+        return rating
+    try:
+        rating = lastfmartistfetch(tags.artist, listeners)
+    except Unavailable:
+        rating = -1
+    return rating if rating >= 0 else sys.maxint
+
+def lastfmplaycountbound(track):
+    """Return an upper bound of the Last.fm playcount."""
+    return lastfmbound(track)
+
+def lastfmlistenersbound(track):
+    """Return an upper bound of the Last.fm listeners."""
+    return lastfmbound(track, True)
 
 def lastfmplaycountrating(track):
     """Return Last.fm playcount."""
-    return lastfmrating(track, True)
+    return lastfmrating(track)
 
 def lastfmlistenersrating(track):
     """Return Last.fm listeners."""
@@ -399,53 +1322,58 @@ def lastfmproductrating(track):
     """Return Last.fm playcount times Last.fm listeners."""
     playcount = lastfmrating(track)
     listeners = lastfmrating(track, True)
+    if playcount < 0 or listeners < 0: return -1
     return playcount * listeners
 
 def lastfmdivisionrating(track):
     """Return Last.fm playcount per Last.fm listeners."""
     playcount = lastfmrating(track)
     listeners = lastfmrating(track, True)
+    if listeners <= 0: return -1
     return float(playcount) / float(listeners)
 
 # Merge functions
 
-def join(xss):
+def join(xss, limit=0):
     """Chain playlists together."""
-    return reduce(lambda x, y: x + y, xss, [])
+    xs = itertools.chain.from_iterable(xss)
+    if limit > 0:
+        xs = itertools.islice(xs, limit)
+    return list(xs)
 
-def interleave(xss):
+def interleave(xss, limit=0):
     """Interleave playlists by alternating between them."""
-    return performmerge(xss, 0, 0, False, False)
+    return performmerge(xss, 0, 0, False, False, limit)
 
-def interleaveshuffle(xss):
+def interleaveshuffle(xss, limit=0):
     """Interleave playlists by randomly alternating between them."""
-    return performmerge(xss, 0, 0, True, False)
+    return performmerge(xss, 0, 0, True, False, limit)
 
-def mergewindow(m, n, xss):
+def mergewindow(m, n, xss, limit=0):
     """Interleave n tracks from m playlists."""
-    return performmerge(xss, m, n, False, False)
+    return performmerge(xss, m, n, False, False, limit)
 
-def slidingwindow(m, n, xss):
+def slidingwindow(m, n, xss, limit=0):
     """Interleave n tracks from m playlists."""
-    return performmerge(xss, m, n, False, True)
+    return performmerge(xss, m, n, False, True, limit)
 
-def shufflewindow(m, n, xss):
+def shufflewindow(m, n, xss, limit=0):
     """Randomly interleave n tracks from m playlists."""
-    return performmerge(xss, m, n, True, False)
+    return performmerge(xss, m, n, True, False, limit)
 
-def tumble5x5(xss):
+def tumble5x5(xss, limit=0):
     """Merge five artists at a time."""
-    return mergewindow(5, 5, xss)
+    return mergewindow(5, 5, xss, limit)
 
-def slide5x5(xss):
+def slide5x5(xss, limit=0):
     """Slide five artists at a time."""
-    return slidingwindow(5, 5, xss)
+    return slidingwindow(5, 5, xss, limit)
 
-def shuffle5x5(xss):
+def shuffle5x5(xss, limit=0):
     """Shuffle five artists at a time."""
-    return shufflewindow(5, 5, xss)
+    return shufflewindow(5, 5, xss, limit)
 
-def union(xss):
+def union(xss, limit=0):
     """
     Interleave the union of two playlists.
     Elements unique to XS are picked over elements unique to YS,
@@ -468,51 +1396,62 @@ def union(xss):
     x:merge xs (ys1 ++ ys2)
     """
     def union2(xs, ys):
-        xs2 = deletedup(xs)
-        ys2 = deletedup(ys)
+        xs2 = deque(deletedup(xs))
+        ys2 = deque(deletedup(ys))
+        xset = set(xs)
+        yset = set(ys)
+        taken = set() # common elements already picked from XS
         result = []
         while xs2 and ys2:
-            if xs2[0] not in ys:
-                result.append(xs2.pop(0))
-            elif ys2[0] not in xs:
-                result.append(ys2.pop(0))
+            if ys2[0] in taken:
+                ys2.popleft()
+            elif xs2[0] not in yset:
+                result.append(xs2.popleft())
+            elif ys2[0] not in xset:
+                result.append(ys2.popleft())
             else:
-                x = xs2.pop(0)
-                while x in ys2: ys2.remove(x)
+                x = xs2.popleft()
+                taken.add(x)
                 result.append(x)
-        return result + xs2 + ys2
-    return reduce(union2, xss, [])
+        return result + list(xs2) + [y for y in ys2 if y not in taken]
+    return truncate(reduce(union2, xss, []), limit)
 
-def intersection(xss):
+def intersection(xss, limit=0):
     """Interleave the intersection of playlists."""
     def intersection2(xs, ys):
+        ys = set(ys)
         return [x for x in deletedup(xs) if x in ys]
-    return reduce(intersection2, xss) if xss else []
+    return truncate(reduce(intersection2, xss) if xss else [], limit)
 
-def difference(xss):
+def difference(xss, limit=0):
     """Calculate the difference between two playlists."""
     def diff(xs, ys):
+        ys = set(ys)
         return [x for x in deletedup(xs) if x not in ys]
-    return reduce(diff, xss) if xss else []
+    return truncate(reduce(diff, xss) if xss else [], limit)
 
-def symmetricdifference(xss):
+def symmetricdifference(xss, limit=0):
     """Interleave the symmetric difference of playlists."""
     def diff(xs, ys):
-        xs2 = deletedup(xs)
-        ys2 = deletedup(ys)
+        xs2 = deque(deletedup(xs))
+        ys2 = deque(deletedup(ys))
+        xset = set(xs)
+        yset = set(ys)
+        common = set() # common elements already dropped from XS
         result = []
         while xs2 and ys2:
-            if xs2[0] not in ys:
-                result.append(xs2.pop(0))
-            elif ys2[0] not in xs:
-                result.append(ys2.pop(0))
+            if ys2[0] in common:
+                ys2.popleft()
+            elif xs2[0] not in yset:
+                result.append(xs2.popleft())
+            elif ys2[0] not in xset:
+                result.append(ys2.popleft())
             else:
-                x = xs2.pop(0)
-                while x in ys2: ys2.remove(x)
-        return result + xs2 + ys2
-    return reduce(diff, xss, [])
+                common.add(xs2.popleft())
+        return result + list(xs2) + [y for y in ys2 if y not in common]
+    return truncate(reduce(diff, xss, []), limit)
 
-def overlay(xss):
+def overlay(xss, limit=0):
     """
     Interleave two playlists by overlaying unique elements.
     Elements from YS are only picked if they are unique.
@@ -532,73 +1471,75 @@ def overlay(xss):
     x:merge xs ys
     """
     def overlay2(xs, ys):
-        xs2 = deletedup(xs)
-        ys2 = deletedup(ys)
+        xs2 = deque(deletedup(xs))
+        ys2 = deque(deletedup(ys))
+        xset = set(xs)
+        yset = set(ys)
         result = []
         while xs2 and ys2:
-            if xs2[0] not in ys:
-                result.append(xs2.pop(0))
-            elif ys2[0] not in xs:
-                result.append(ys2.pop(0))
+            if xs2[0] not in yset:
+                result.append(xs2.popleft())
+            elif ys2[0] not in xset:
+                result.append(ys2.popleft())
             else:
-                ys2.pop(0)
-                result.append(xs2.pop(0))
-        return result + xs2 + ys2
-    return reduce(overlay2, xss, [])
+                ys2.popleft()
+                result.append(xs2.popleft())
+        return result + list(xs2) + list(ys2)
+    return truncate(reduce(overlay2, xss, []), limit)
 
 # Group functions
 
 def groupartist(xs):
     """Group a playlist on artist."""
     def artist(x):
-        return id3(x)['artist']
+        return TRACKS.tags(x).artist
     return performgroup(xs, artist)
 
 def groupdir(xs):
     """Group a playlist on directory."""
-    prefix = os.path.commonprefix(xs)
+    prefix = os.path.commonprefix(map(TRACKS.path, xs))
+    regexp = re.compile('^%s([^/]+)' % re.escape(prefix))
     def dir(x):
-        regexp = '^%s([^/]+)' % re.escape(prefix)
-        match = re.match(regexp, x)
+        match = regexp.match(TRACKS.path(x))
         return match.group(1) if match else ''
     return performgroup(xs, dir)
 
 def groupdir2(xs):
     """Group a playlist on subdirectory."""
-    prefix = os.path.commonprefix(xs)
+    prefix = os.path.commonprefix(map(TRACKS.path, xs))
+    regexp = re.compile('^%s([^/]+/[^/]+)' % re.escape(prefix))
     def dir(x):
-        regexp = '^%s([^/]+/[^/]+)' % re.escape(prefix)
-        match = re.match(regexp, x)
+        match = regexp.match(TRACKS.path(x))
         return match.group(1) if match else ''
     return performgroup(xs, dir)
 
 # Sort functions
 
-def lastfmplaycount(xs):
+def lastfmplaycount(xs, limit=0):
     """Sort tracks by Last.fm playcount."""
-    return sort(xs, lastfmplaycountrating)
+    return sort(xs, lastfmplaycountrating, limit)
 
-def lastfmlisteners(xs):
+def lastfmlisteners(xs, limit=0):
     """Sort tracks by Last.fm listeners."""
-    return sort(xs, lastfmlistenersrating)
+    return sort(xs, lastfmlistenersrating, limit)
 
-def lastfmproduct(xs):
+def lastfmproduct(xs, limit=0):
     """Sort tracks by Last.fm playcount times Last.fm listeners."""
-    return sort(xs, lastfmproductrating)
+    return sort(xs, lastfmproductrating, limit)
 
-def lastfmdivision(xs):
+def lastfmdivision(xs, limit=0):
     """Sort tracks by Last.fm playcount per Last.fm listeners."""
-    return sort(xs, lastfmdivisionrating)
+    return sort(xs, lastfmdivisionrating, limit)
 
 def shuffle(xs):
     """Shuffle a playlist."""
+    xs = list(xs) # the playlist may be shared with other sessions
     random.shuffle(xs)
     return xs
 
 def reverse(xs):
     """Reverse a playlist."""
-    xs.reverse()
-    return xs
+    return xs[::-1]
 
 # Presets
 
@@ -708,56 +1649,321 @@ orderings = { 'lastfm' : lastfmplaycount,
               'identity' : deletedup,
               'none' : deletedup }
 
+# rating functions of the orderings that fetch ratings
+ratings = { lastfmplaycount : lastfmplaycountrating,
+            lastfmlisteners : lastfmlistenersrating,
+            lastfmproduct : lastfmproductrating,
+            lastfmdivision : lastfmdivisionrating }
+
+# upper bounds of the rating functions, see select()
+bounds = { lastfmplaycountrating : lastfmplaycountbound,
+           lastfmlistenersrating : lastfmlistenersbound }
+
+# merge functions that may look beyond the first LIMIT tracks
+# of a playlist, so the playlists must not be cut short
+setmerges = [union, intersection, difference, symmetricdifference, overlay]
+
+# Sessions
+
+class Session:
+    """
+    Settings for processing playlists.
+    A session holds the options of main(), so that a program can
+    import this module and process playlists as often as it likes,
+    from several threads at once, without touching the module
+    globals. The tracks, tags and ratings are cached for the whole
+    process and shared by all sessions, as are the pools of API keys,
+    so sessions with the same keys share the same request budget.
+    By default, the settings are taken from the module globals.
+
+        session = last.Session(order='listeners', merge='merge')
+        xss = map(session.load, ['folder1', 'folder2'])
+        session.write(session.process(xss), 'out.m3u')
+    """
+    def __init__(self, api=None, merge=None, group=None, order=None,
+                 gfirst=None, base=None, limit=None, quiet=True):
+        self.api = API if api is None else api
+        self.base = BASE if base is None else base
+        self.limit = LIMIT if limit is None else limit
+        self.gfirst = GFIRST if gfirst is None else gfirst
+        self.quiet = quiet # don't print progress
+        merge = MERGE if merge is None else merge
+        group = GROUP if group is None else group
+        order = ORDER if order is None else order
+        self.merging = mergings[merge] if merge else join
+        self.grouping = groupings[group] if group else performgroup
+        self.ordering = orderings[order] if order else lastfmplaycount
+        if merge and not group:
+            self.grouping = groupartist
+        if group and not merge:
+            self.merging = slide5x5
+        # with a limit, no ordered playlist can contribute more than
+        # LIMIT tracks, unless the tracks are grouped after ordering
+        # or merged with a set operation
+        self.rating = ratings.get(self.ordering)
+        if (self.limit > 0 and self.rating and
+            self.merging not in setmerges and
+            (self.gfirst or self.grouping == performgroup)):
+            self.ordering = functools.partial(self.ordering,
+                                              limit=self.limit)
+            self.rating = None # the ordering fetches what it needs
+
+    def load(self, path):
+        """Load a playlist or folder."""
+        return load(path)
+
+    def group(self, xs):
+        """Group a playlist."""
+        return self.grouping(xs)
+
+    def order(self, xs):
+        """Order a playlist."""
+        with using(self):
+            return self.ordering(xs)
+
+    def merge(self, xss):
+        """Merge playlists."""
+        return self.merging(xss, self.limit)
+
+    def process(self, xss):
+        """Order, group and merge playlists."""
+        with using(self):
+            # fetch the ratings of all the playlists in one go,
+            # so that the orderings below need not wait
+            if self.rating:
+                prefetch(join(xss), self.rating)
+            if self.gfirst:
+                xss = map(self.order, join(map(self.group, xss)))
+            else:
+                xss = join(map(self.group, map(self.order, xss)))
+            return self.merge(xss)
+
+    def write(self, xs, file=None):
+        """Write a playlist to file, if given, and return it as a string."""
+        return write(xs, file, self.base, True)
+
+    def submit(self, xss, callback=None, timeout=0):
+        """
+        Process playlists in the background and return a Job.
+        CALLBACK, if given, is called with the job once it is done.
+        The job is cancelled if it takes more than TIMEOUT seconds.
+        """
+        job = Job(self, xss, timeout)
+        if callback:
+            job.then(callback)
+        runner().apply_async(job.run)
+        return job
+
+class Job:
+    """
+    Playlists being processed in the background, see Session.submit().
+    Jobs are run by a pool of JOBS threads, so that many playlists
+    can be processed at once without a thread per playlist; all jobs
+    share the request budget and the caches. A job can be waited for,
+    given callbacks, and cancelled, in which case it makes no further
+    requests and stops waiting for keys; requests under way, each in
+    a child process forked by timeout(), are finished. Callbacks are
+    called in the thread that ran the job, so a program with an event
+    loop should hand the result over to the loop's thread.
+    """
+    def __init__(self, session, xss, timeout=0):
+        self.session = session
+        self.xss = xss
+        self.deadline = time.time() + timeout if timeout > 0 else 0
+        self.cancelled = threading.Event()
+        self.result = None
+        self.error = None
+        self.callbacks = []
+        self.finished = threading.Event()
+        self.lock = threading.Lock()
+
+    def run(self):
+        """Process the playlists."""
+        result = error = None
+        try:
+            if self.stopped():
+                raise Cancelled()
+            with using(self.session, self):
+                result = self.session.process(self.xss)
+        except Exception as e:
+            error = Cancelled() if self.stopped() else e
+        self.finish(result, error)
+
+    def finish(self, result, error):
+        """
+        Store the outcome and call the callbacks. A failing callback
+        is reported on standard error; it does not change the outcome
+        or keep the other callbacks from being called.
+        """
+        with self.lock:
+            self.result = result
+            self.error = error
+            self.finished.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                traceback.print_exc()
+
+    def then(self, callback):
+        """Call CALLBACK with the job once it is done."""
+        with self.lock:
+            if not self.finished.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def cancel(self):
+        """Stop processing the playlists."""
+        self.cancelled.set()
+
+    def stopped(self):
+        """Whether the job was cancelled or ran out of time."""
+        return self.cancelled.is_set() or 0 < self.deadline < time.time()
+
+    def wait(self, seconds):
+        """Sleep for SECONDS, waking up once the job is stopped."""
+        if self.deadline:
+            seconds = min(seconds, max(0, self.deadline - time.time()))
+        self.cancelled.wait(seconds)
+
+    def done(self):
+        """Whether the job is done."""
+        return self.finished.is_set()
+
+    def get(self, timeout=None):
+        """
+        Wait for the job and return the processed playlist.
+        Raises the job's error, Cancelled if it was cancelled, or
+        multiprocessing.TimeoutError if it is not done in time.
+        """
+        if not self.finished.wait(timeout):
+            raise multiprocessing.TimeoutError()
+        if self.error:
+            raise self.error
+        return self.result
+
+RUNNER = None # pool of threads running jobs, see runner()
+RUNNERLOCK = threading.Lock()
+
+def runner():
+    """Return the pool of threads running jobs, creating it on first use."""
+    global RUNNER
+    with RUNNERLOCK:
+        if RUNNER is None:
+            RUNNER = ThreadPool(JOBS)
+        return RUNNER
+
 # Main function
 
 def main():
-    global API, MERGE, GROUP, ORDER, GFIRST, BASE, OUTPUT
-    global mergings, groupings, orderings
+    global API, MERGE, GROUP, ORDER, GFIRST, BASE, OUTPUT, LIMIT, WATCH
+    global REFRESH
 
-    merge = join
-    group = performgroup
-    order = lastfmplaycount
+    keys = []
 
     opts, args = getopt.getopt(sys.argv[1:],
-                               'a:b:m:g:o:',
+                               'a:b:m:g:o:l:wr:',
                                ['api=',
                                 'base=',
                                 'merge=',
                                 'group=',
-                                'order='])
+                                'order=',
+                                'limit=',
+                                'watch',
+                                'refresh='])
 
     for o, v in opts:
         if o in ('-a', '--api'):
-            API = v
+            keys.append(v)
         if o in ('-b', '--base'):
             BASE = v
+        if o in ('-l', '--limit'):
+            LIMIT = int(v)
+        if o in ('-w', '--watch'):
+            WATCH = True
+        if o in ('-r', '--refresh'):
+            REFRESH = float(v)
         if o in ('-m', '--merge'):
             MERGE = v.lower().strip()
-            merge = mergings[MERGE]
         elif o in ('-g', '--group'):
             GROUP = v.lower().strip()
-            group = groupings[GROUP]
         elif o in ('-o', '--order'):
             ORDER = v.lower().strip()
-            order = orderings[ORDER]
             if GROUP: GFIRST = True
 
+    if keys:
+        API = ','.join(keys)
+
     if len(args) > 1:
         OUTPUT = args.pop()
 
-    if MERGE and not GROUP:
-        group = groupartist
-    if GROUP and not MERGE:
-        merge = slide5x5
-
-    xss = map(load, args)
-
-    if GFIRST:
-        result = merge(map(order, join(map(group, xss))))
-    else:
-        result = merge(join(map(group, map(order, xss))))
-
-    write(result, OUTPUT, BASE)
+    if REFRESH > 0 and not OUTPUT:
+        sys.exit('The -r option requires an output file.')
+
+    session = Session(quiet=False)
+    loaded = [] # tracks of the input playlists
+    lock = threading.Lock()
+
+    def process(listings=None):
+        listings = listings or {} # folder -> tracks found by watch()
+        xss = [listings[path] if path in listings else session.load(path)
+               for path in args]
+        loaded[:] = join(xss)
+        return session.process(xss)
+
+    result = process()
+    print(session.write(result, OUTPUT))
+
+    # keep the output up to date: whenever tracks are added or removed,
+    # the output is generated anew from the folder contents found by
+    # watch(), which only reads the tags and fetches the ratings of
+    # the added tracks
+    def update(added, removed, listings):
+        with lock:
+            for x in removed:
+                TRACKS.forget(x)
+            result[:] = process(listings)
+            session.write(result, OUTPUT)
+
+    # the output is written from the cached ratings first, and written
+    # again once the stale ones have been refreshed
+    def refreshed():
+        with lock:
+            result[:] = process()
+            session.write(result, OUTPUT)
+
+    if REFRESH > 0 and WATCH:
+        # refresh with the spare requests, alongside the updates
+        with using(session):
+            refresher = Refresher(loaded, REFRESH * 24 * 60 * 60, refreshed,
+                                  lock=lock)
+        refresher.start()
+    elif REFRESH > 0:
+        # nothing else to do: refresh at the full rate, and write the
+        # output now and then, so that little is lost if interrupted
+        with using(session):
+            refresher = Refresher(loaded, REFRESH * 24 * 60 * 60,
+                                  spare=1, lock=lock,
+                                  workers=WORKERS * len(keypool().keys))
+        refresher.start()
+        written = 0
+        try:
+            while refresher.is_alive():
+                refresher.join(REWRITE)
+                if refresher.changed > written:
+                    written = refresher.changed
+                    refreshed()
+        except KeyboardInterrupt:
+            refresher.stop()
+            if refresher.changed > written:
+                refreshed()
+            raise
+
+    if WATCH:
+        watch(args, update)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+
+"""
+Load test for the fetching in last.py.
+
+Usage:
+
+    lastbench.py [-n tracks] [-d duplicates] [-k keys] [-w workers]
+                 [-r rate] [-l latency] [-e errors] [-m missing] [-t rate]
+                 [--limit n] [--html]
+
+Starts a fake Last.fm server (see lastserver.py), sorts a playlist
+of made-up tracks with last.sort() against it, and reports the
+throughput, the latency of the requests and whether the requests
+stayed within Last.fm's rate limit of 5 per second per API key,
+averaged over a 5 minute period.
+
+The -n option sets the number of tracks and the -d option the
+fraction of tracks that are copies of another track. The -k option
+sets the number of API keys, and the -w and -r options set the number
+of workers and the request rate per key. The -l, -e, -m and -t options
+are passed on to the server. The --limit option selects only the
+best N tracks. The --html option scrapes track pages instead of
+using the API.
+
+    lastbench.py -n 500 -r 20
+    lastbench.py -n 200 -l 0.2 -e 0.05 -t 4
+    lastbench.py -n 200 -k 3
+    lastbench.py -n 500 --limit 50
+"""
+
+import getopt
+import os
+import random
+import sys
+import time
+
+import last
+import lastserver
+
+QUOTA = 5 * 300 # requests per 5 minutes per key
+
+def percentile(xs, p):
+    """Return the P-th percentile of a sorted list."""
+    if not xs:
+        return 0
+    return xs[int(round(p / 100.0 * (len(xs) - 1)))]
+
+def peak(times, window):
+    """Return the largest number of requests within a time window."""
+    result = 0
+    beg = 0
+    for end in range(len(times)):
+        while times[end] - times[beg] >= window:
+            beg += 1
+        result = max(result, end - beg + 1)
+    return result
+
+def tracks(n, duplicates=0):
+    """Make up a playlist of N tracks."""
+    xs = []
+    songs = []
+    for i in range(n):
+        x = last.TRACKS.add('/bench/%d.mp3' % i)
+        if songs and random.random() < duplicates:
+            artist, title = random.choice(songs)
+        else:
+            artist = 'Artist %d' % (i % 50)
+            title = 'Title %d' % i
+            songs.append((artist, title))
+        last.TRACKS.settags(x, last.Track(artist, title))
+        xs.append(x)
+    return xs
+
+def run(xs, keys=1, limit=0, html=False):
+    """Sort a playlist, returning the request latencies."""
+    latencies = []
+    timeout = last.timeout
+    def timed(*args, **kwargs):
+        start = time.time()
+        try:
+            return timeout(*args, **kwargs)
+        finally:
+            latencies.append(time.time() - start)
+    last.timeout = timed
+    last.API = '' if html else ','.join('bench%d' % i for i in range(keys))
+    last.KEYS, last.CONTROLLERS = {}, {}
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        last.sort(xs, last.lastfmplaycountrating, limit)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        last.timeout = timeout
+    return latencies
+
+def main():
+    n = 200
+    duplicates = 0
+    keys = 1
+    limit = 0
+    html = False
+    latency = errors = missing = throttle = 0
+
+    opts, args = getopt.getopt(sys.argv[1:],
+                               'n:d:k:w:r:l:e:m:t:',
+                               ['tracks=',
+                                'duplicates=',
+                                'keys=',
+                                'workers=',
+                                'rate=',
+                                'latency=',
+                                'errors=',
+                                'missing=',
+                                'throttle=',
+                                'limit=',
+                                'html'])
+
+    for o, v in opts:
+        if o in ('-n', '--tracks'):
+            n = int(v)
+        elif o in ('-d', '--duplicates'):
+            duplicates = float(v)
+        elif o in ('-k', '--keys'):
+            keys = int(v)
+        elif o in ('-w', '--workers'):
+            last.WORKERS = int(v)
+        elif o in ('-r', '--rate'):
+            last.RATE = float(v)
+        elif o in ('-l', '--latency'):
+            latency = float(v)
+        elif o in ('-e', '--errors'):
+            errors = float(v)
+        elif o in ('-m', '--missing'):
+            missing = float(v)
+        elif o in ('-t', '--throttle'):
+            throttle = int(v)
+        elif o == '--limit':
+            limit = int(v)
+        elif o == '--html':
+            html = True
+
+    server = lastserver.Server(('localhost', 0),
+                               latency, errors, missing, throttle)
+    server.start()
+    last.XMLURL = server.url() + '2.0/?'
+    last.HTMLURL = server.url() + 'music/'
+
+    xs = tracks(n, duplicates)
+    start = time.time()
+    try:
+        latencies = run(xs, keys, limit, html)
+    finally:
+        server.stop()
+    elapsed = time.time() - start
+
+    latencies.sort()
+    times = sorted(server.log)
+    quota = QUOTA * (1 if html else keys)
+    print('tracks:     %d (%d requests)' % (n, len(times)))
+    print('time:       %.2f s' % elapsed)
+    print('throughput: %.2f tracks/s' % (n / elapsed))
+    print('latency:    p50 %.3f s, p99 %.3f s' %
+          (percentile(latencies, 50), percentile(latencies, 99)))
+    print('peak rate:  %d requests/s' % peak(times, 1))
+    print('quota:      %d of %d requests per 5 minutes (%s)' %
+          (peak(times, 300), quota,
+           'ok' if peak(times, 300) <= quota else 'exceeded'))
+    print('final rate: %.2f requests/s' % last.keypool().rate())
+
+if __name__ == '__main__':
+    main()
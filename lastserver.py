@@ -0,0 +1,245 @@
+#!/usr/bin/python
+
+"""
+Fake Last.fm server for testing and benchmarking last.py.
+
+Usage:
+
+    lastserver.py [-p port] [-l latency] [-e errors] [-m missing] [-t rate]
+
+Serves track.getInfo and artist.getInfo XML under /2.0/ and track
+pages under /music/,
+so that last.py can be pointed at it by setting XMLURL and HTMLURL:
+
+    last.XMLURL = 'http://localhost:8000/2.0/?'
+    last.HTMLURL = 'http://localhost:8000/music/'
+
+The -l option sets the mean response time in seconds. The -e and -m
+options set the fraction of requests failing with a temporary error
+(Last.fm error 16 or HTTP 503) and of tracks not found (Last.fm error
+6 or HTTP 404). The -t option sets the number of requests per second
+allowed per API key; requests beyond it are rejected with Last.fm
+error 29 or HTTP 429.
+
+Ratings are derived from the artist and title, so they are the same
+on every run. A track's ratings never exceed those of its artist.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import getopt
+import random
+import sys
+import threading
+import time
+import urllib
+import urlparse
+import zlib
+
+from collections import deque
+from xml.sax.saxutils import escape
+
+XML = '''<?xml version="1.0" encoding="utf-8"?>
+<lfm status="ok">
+<track>
+<name>%s</name>
+<artist><name>%s</name></artist>
+<listeners>%d</listeners>
+<playcount>%d</playcount>
+</track>
+</lfm>
+'''
+
+ARTISTXML = '''<?xml version="1.0" encoding="utf-8"?>
+<lfm status="ok">
+<artist>
+<name>%s</name>
+<stats>
+<listeners>%d</listeners>
+<playcount>%d</playcount>
+</stats>
+</artist>
+</lfm>
+'''
+
+XMLERROR = '''<?xml version="1.0" encoding="utf-8"?>
+<lfm status="failed">
+<error code="%d">%s</error>
+</lfm>
+'''
+
+HTML = '''<html>
+<head><title>%s - %s</title></head>
+<body>
+<ul>
+<li class="listeners">%s listeners</li>
+<li class="scrobbles">%s scrobbles</li>
+</ul>
+</body>
+</html>
+'''
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Fake Last.fm server."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('localhost', 0),
+                 latency=0, errors=0, missing=0, rate=0):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.latency = latency # mean response time in seconds
+        self.errors = errors   # fraction of temporary errors
+        self.missing = missing # fraction of tracks not found
+        self.rate = rate       # requests per second per key, 0 for no limit
+        self.log = []          # time of each request
+        self.recent = {}       # key -> times of requests in the last second
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def url(self):
+        """Return the base URL of the server."""
+        return 'http://%s:%d/' % self.server_address
+
+    def admit(self, key=''):
+        """Log a request and return whether it is within the rate limit."""
+        now = time.time()
+        with self.lock:
+            self.log.append(now)
+            if self.rate <= 0:
+                return True
+            recent = self.recent.setdefault(key, deque())
+            while recent and recent[0] <= now - 1:
+                recent.popleft()
+            if len(recent) >= self.rate:
+                return False
+            recent.append(now)
+            return True
+
+    def delay(self):
+        """Wait for a random time averaging the latency."""
+        if self.latency > 0:
+            time.sleep(random.uniform(0, 2 * self.latency))
+
+    def start(self):
+        """Serve requests in a background thread."""
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop serving requests."""
+        self.shutdown()
+        self.server_close()
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Request handler of the fake Last.fm server."""
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path.startswith('/2.0'):
+            self.xml(dict(urlparse.parse_qsl(url.query)))
+        elif url.path.startswith('/music/'):
+            self.html(url.path[len('/music/'):])
+        else:
+            self.reply(404, 'text/plain', 'Not found\n')
+
+    def xml(self, query):
+        """Serve track.getInfo and artist.getInfo."""
+        server = self.server
+        method = query.get('method', '')
+        artist = query.get('artist', '')
+        title = query.get('track', '')
+        if not server.admit(query.get('api_key', '')):
+            body = XMLERROR % (29, 'Rate limit exceeded')
+        elif random.random() < server.errors:
+            body = XMLERROR % (16, 'Service temporarily unavailable')
+        elif not query.get('api_key'):
+            body = XMLERROR % (10, 'Invalid API key')
+        elif method == 'artist.getInfo' and artist:
+            listeners, playcount = artistrating(artist)
+            body = ARTISTXML % (escape(artist), listeners, playcount)
+        elif not artist or not title or random.random() < server.missing:
+            body = XMLERROR % (6, 'Track not found')
+        else:
+            listeners, playcount = rating(artist, title)
+            body = XML % (escape(title), escape(artist),
+                          listeners, playcount)
+        server.delay()
+        self.reply(200, 'text/xml', body)
+
+    def html(self, path):
+        """Serve a track page."""
+        server = self.server
+        artist, sep, title = path.partition('/_/')
+        artist = urllib.unquote_plus(artist)
+        title = urllib.unquote_plus(title)
+        if not server.admit():
+            status, body = 429, 'Too many requests\n'
+        elif random.random() < server.errors:
+            status, body = 503, 'Service unavailable\n'
+        elif not sep or random.random() < server.missing:
+            status, body = 404, 'Not found\n'
+        else:
+            listeners, playcount = rating(artist, title)
+            status, body = 200, HTML % (escape(artist), escape(title),
+                                        '{:,}'.format(listeners),
+                                        '{:,}'.format(playcount))
+        server.delay()
+        self.reply(status, 'text/html', body)
+
+    def reply(self, status, type, body):
+        """Send a response."""
+        self.send_response(status)
+        self.send_header('Content-Type', '%s; charset=utf-8' % type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def rating(artist, title):
+    """Return the listeners and playcount of a track."""
+    hash = zlib.crc32('%s\t%s' % (artist.lower(), title.lower()))
+    hash &= 0xffffffff
+    listeners = artistrating(artist)[0] * (hash % 100) // 100
+    return listeners, listeners * (1 + hash % 17)
+
+def artistrating(artist):
+    """Return the listeners and playcount of an artist."""
+    hash = zlib.crc32(artist.lower()) & 0xffffffff
+    listeners = (hash % 1000) ** 2 + 1000
+    return listeners, listeners * 17 # more than that of any track
+
+def main():
+    port = 8000
+    latency = errors = missing = rate = 0
+
+    opts, args = getopt.getopt(sys.argv[1:],
+                               'p:l:e:m:t:',
+                               ['port=',
+                                'latency=',
+                                'errors=',
+                                'missing=',
+                                'throttle='])
+
+    for o, v in opts:
+        if o in ('-p', '--port'):
+            port = int(v)
+        elif o in ('-l', '--latency'):
+            latency = float(v)
+        elif o in ('-e', '--errors'):
+            errors = float(v)
+        elif o in ('-m', '--missing'):
+            missing = float(v)
+        elif o in ('-t', '--throttle'):
+            rate = int(v)
+
+    server = Server(('localhost', port), latency, errors, missing, rate)
+    print('Serving on %s' % server.url())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -5,8 +5,17 @@ Unit tests for last.py.
 """
 
 import last
+import lastserver
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
+from mutagen.easyid3 import EasyID3
+
 class TestFunctions(unittest.TestCase):
     def testjoin(self):
         """Test join."""
@@ -90,6 +99,377 @@ class TestFunctions(unittest.TestCase):
         self.assertEqual(last.overlay([['1', '3'], ['2', '3']]),
                          ['1', '2', '3'])
 
+    def testtracks(self):
+        """Test Tracks."""
+        tracks = last.Tracks()
+        x = tracks.add('/music/a/1.mp3')
+        y = tracks.add('/music/a/2.mp3')
+        z = tracks.add('/music/b/1.mp3')
+        self.assertEqual(tracks.add('/music/a/1.mp3'), x)
+        self.assertEqual(len(set([x, y, z])), 3)
+        self.assertEqual(len(tracks), 3)
+        self.assertEqual(len(tracks.dirs), 2)
+        self.assertEqual(tracks.path(y), '/music/a/2.mp3')
+        self.assertEqual(tracks.path('/music/c/3.mp3'), '/music/c/3.mp3')
+        self.assertEqual(tracks.id('/music/b/1.mp3'), z)
+        # threads reading the tags at once get the same record,
+        # and tags set meanwhile are kept
+        id3 = last.id3
+        def slowid3(path):
+            time.sleep(0.05)
+            return {'artist': 'Read', 'title': path}
+        last.id3 = slowid3
+        try:
+            results = []
+            threads = [threading.Thread(target=lambda:
+                                        results.append(tracks.tags(x)))
+                       for i in range(4)]
+            threads.append(threading.Thread(target=tracks.tags, args=[y]))
+            for thread in threads:
+                thread.start()
+            time.sleep(0.01)
+            tracks.settags(y, last.Track('Set', 'Title'))
+            for thread in threads:
+                thread.join()
+        finally:
+            last.id3 = id3
+        self.assertEqual(len(set(map(id, results))), 1)
+        self.assertTrue(tracks.tags(x) is results[0])
+        self.assertEqual(tracks.tags(y).artist, 'Set')
+
+    def testloadplaylist(self):
+        """Test loadplaylist."""
+        dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(dir, 'list.m3u')
+            file = open(path, 'w')
+            file.write('#EXTM3U\r\n'
+                       '#EXTINF:215,Artist - Some - Title\r\n'
+                       'a/1.mp3\r\n'
+                       '\r\n'
+                       '# comment\r\n'
+                       '../b/2.mp3\r\n')
+            file.close()
+            xs = last.loadplaylist(path)
+            self.assertEqual(map(last.TRACKS.path, xs),
+                             [os.path.join(dir, 'a', '1.mp3'),
+                              os.path.join(os.path.dirname(dir), 'b', '2.mp3')])
+            tags = last.TRACKS.tags(xs[0])
+            self.assertEqual((tags.artist, tags.title, tags.duration),
+                             ('Artist', 'Some - Title', 215))
+        finally:
+            shutil.rmtree(dir)
+
+    def testwritefile(self):
+        """Test writefile."""
+        dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(dir, 'out.m3u')
+            last.writefile(path, 'old\n')
+            last.writefile(path, 'new\n')
+            self.assertEqual(open(path).read(), 'new\n')
+            self.assertEqual(os.listdir(dir), ['out.m3u'])
+        finally:
+            shutil.rmtree(dir)
+
+    def testwatch(self):
+        """Test watch."""
+        dir = tempfile.mkdtemp()
+        try:
+            for name in ('1.mp3', '2.mp3'):
+                open(os.path.join(dir, name), 'w').close()
+            def events():
+                os.remove(os.path.join(dir, '1.mp3'))
+                yield
+                yield # nothing changed
+                open(os.path.join(dir, '3.mp3'), 'w').close()
+                yield
+            updates = []
+            def update(added, removed, listings):
+                updates.append((sorted(map(last.TRACKS.path, added)),
+                                sorted(map(last.TRACKS.path, removed)),
+                                map(last.TRACKS.path, listings[dir])))
+            last.watch([dir], update, events())
+            paths = [os.path.join(dir, name)
+                     for name in ('1.mp3', '2.mp3', '3.mp3')]
+            self.assertEqual(updates,
+                             [([], paths[:1], paths[1:2]),
+                              (paths[2:], [], paths[1:])])
+        finally:
+            shutil.rmtree(dir)
+
+    def testid3(self):
+        """Test id3."""
+        dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(dir, '1.mp3')
+            tags = EasyID3()
+            tags['artist'] = u'Art'
+            tags['title'] = u'Tit'
+            tags['albumartist'] = u'Various'
+            tags.save(path) # tags without any MPEG frames
+            meta = last.id3(path)
+            self.assertEqual((meta['artist'], meta['title'],
+                              meta['albumartist'], meta['duration']),
+                             ('Art', 'Tit', 'Various', -1))
+            self.assertEqual(last.id3(os.path.join(dir, '2.mp3'))['artist'],
+                             '')
+        finally:
+            shutil.rmtree(dir)
+
+    def testparseextinf(self):
+        """Test parseextinf."""
+        self.assertEqual(last.parseextinf('#EXTINF:-1,Title'), None)
+        self.assertEqual(last.parseextinf('#EXTINF:bad'), None)
+        tags = last.parseextinf('#EXTINF:12.5,A - B')
+        self.assertEqual((tags.artist, tags.title, tags.duration),
+                         ('A', 'B', 12))
+
+    def testextinf(self):
+        """Test extinf."""
+        x = last.TRACKS.add('/music/extinf/1.mp3')
+        self.assertEqual(last.extinf(x), '')
+        last.TRACKS.settags(x, last.Track('A, B', 'C - D', duration=215,
+                                          playcount=1234))
+        line = last.extinf(x)
+        self.assertEqual(line, '#EXTINF:215 playcount="1234" '
+                               'artist="A, B" title="C - D",A, B - C - D')
+        tags = last.parseextinf(line)
+        self.assertEqual((tags.artist, tags.title, tags.duration,
+                          tags.playcount, tags.listeners),
+                         ('A, B', 'C - D', 215, 1234, -1))
+        y = last.TRACKS.add('/music/extinf/2.mp3')
+        last.TRACKS.settags(y, last.Track('Jay - Z', 'The "Song" & Co',
+                                          duration=180))
+        tags = last.parseextinf(last.extinf(y))
+        self.assertEqual((tags.artist, tags.title),
+                         ('Jay - Z', 'The "Song" & Co'))
+        last.TRACKS.cached(x).fetched = 1500000000
+        tags = last.parseextinf(last.extinf(x))
+        self.assertEqual(tags.fetched, 1500000000)
+
+    def testdeletedup(self):
+        """Test deletedup."""
+        self.assertEqual(last.deletedup([]),
+                         [])
+        self.assertEqual(last.deletedup(['1', '2', '1', '3', '2']),
+                         ['1', '2', '3'])
+        self.assertEqual(last.deletedups([['1', '2'], ['2', '3'], []]),
+                         [['1', '2'], ['3']])
+
+    def testsort(self):
+        """Test sort."""
+        calls = []
+        def rating(x):
+            calls.append(x)
+            return {'a': 1, 'b': 3, 'c': -1, 'd': 3}[x]
+        self.assertEqual(last.sort(['a', 'b', 'c', 'd', 'a'], rating),
+                         ['b', 'd', 'a', 'a', 'c'])
+        self.assertEqual(last.sort(['d', 'c'], rating),
+                         ['d', 'c'])
+        self.assertEqual(sorted(calls), ['a', 'b', 'c', 'd'])
+
+    def testselect(self):
+        """Test select."""
+        xs = ['a1', 'a2', 'b1', 'b2', 'c1', 'a3']
+        artists = {'a': 10, 'b': 5, 'c': 2}
+        plays = {'a1': 3, 'a2': 8, 'a3': 6, 'b1': 5, 'b2': 1, 'c1': 2}
+        calls = []
+        def rating(x):
+            calls.append(x)
+            return plays[x]
+        def bound(x):
+            return artists[x[0]]
+        self.assertEqual(last.select(xs + ['a2'], rating, 2, bound),
+                         ['a2', 'a3'])
+        self.assertEqual(sorted(calls), ['a1', 'a2', 'a3', 'b1', 'b2'])
+        self.assertEqual(last.select(xs, rating, 3, bound),
+                         ['a2', 'a3', 'b1'])
+        self.assertEqual(last.sort(xs, rating),
+                         ['a2', 'a3', 'b1', 'a1', 'c1', 'b2'])
+        # all keys rejected by Last.fm
+        api, keys, controllers = last.API, last.KEYS, last.CONTROLLERS
+        last.API, last.KEYS, last.CONTROLLERS = 'bad', {}, {}
+        stderr = sys.stderr
+        sys.stderr = open(os.devnull, 'w')
+        try:
+            last.keypool().remove('bad')
+            result = []
+            thread = threading.Thread(target=lambda: result.append(
+                last.select(xs, rating, 2, bound)))
+            thread.daemon = True
+            thread.start()
+            thread.join(5)
+            self.assertEqual(result, [['a2', 'a3']])
+        finally:
+            sys.stderr.close()
+            sys.stderr = stderr
+            last.API, last.KEYS, last.CONTROLLERS = api, keys, controllers
+
+    def testlimit(self):
+        """Test merging with a limit."""
+        self.assertEqual(last.join([['1', '2'], ['3']], 2),
+                         ['1', '2'])
+        self.assertEqual(last.interleave([['a1', 'a2'], ['b1', 'b2']], 3),
+                         ['a1', 'b1', 'a2'])
+        self.assertEqual(last.slide5x5([['a1', 'a2'], ['b1', 'b2']], 1),
+                         ['a1'])
+        self.assertEqual(last.union([['1', '2'], ['2', '3']], 2),
+                         ['1', '2'])
+
+    def testprefetch(self):
+        """Test prefetch."""
+        xs = [last.TRACKS.add('/music/prefetch/%d.mp3' % i) for i in range(4)]
+        last.TRACKS.settags(xs[0], last.Track('A', 'Song'))
+        last.TRACKS.settags(xs[1], last.Track('B', 'Song'))
+        last.TRACKS.settags(xs[2], last.Track('a', 'song'))
+        last.TRACKS.settags(xs[3], last.Track('A', 'Song', playcount=7))
+        calls = []
+        def rating(x):
+            calls.append(x)
+            return last.TRACKS.tags(x).playcount
+        ratings = last.prefetch(xs + xs[:2], rating)
+        self.assertEqual(sorted(calls), [xs[1], xs[3]])
+        self.assertEqual([ratings[x] for x in xs], [7, 0, 7, 7])
+        self.assertEqual(last.TRACKS.tags(xs[2]).playcount, 7)
+
+    def testratelimiter(self):
+        """Test RateLimiter."""
+        limiter = last.RateLimiter(50, 2)
+        start = time.time()
+        for i in range(7):
+            limiter.wait()
+        self.assertTrue(time.time() - start >= 0.09)
+
+    def testcontroller(self):
+        """Test Controller."""
+        limiter = last.RateLimiter(8, 8)
+        controller = last.Controller(limiter, threshold=2, cooldown=0.05)
+        controller.failure(True)
+        self.assertEqual(limiter.rate, 4)
+        self.assertTrue(controller.closed())
+        controller.success()
+        self.assertEqual(limiter.rate, 4.4)
+        controller.failure()
+        controller.failure()
+        self.assertFalse(controller.closed())
+        time.sleep(0.06)
+        self.assertTrue(controller.closed())
+        controller.failure()
+        self.assertFalse(controller.closed())
+        for i in range(20):
+            controller.success()
+        self.assertTrue(controller.closed())
+        self.assertEqual(limiter.rate, 8)
+
+    def testkeypool(self):
+        """Test KeyPool."""
+        controllers = last.CONTROLLERS
+        last.CONTROLLERS = {}
+        try:
+            pool = last.KeyPool(['a', 'b', 'c'], 2)
+            self.assertEqual(sorted(pool.acquire() for i in range(6)),
+                             ['a', 'a', 'b', 'b', 'c', 'c'])
+            self.assertEqual(pool.rate(), 6)
+            pool.remove('b')
+            for i in range(5):
+                pool.controller('c').failure()
+            self.assertEqual(pool.acquire(), 'a')
+            pool.remove('a')
+            self.assertRaises(last.Unavailable, pool.acquire)
+            self.assertTrue(pool.remaining() > 0)
+            stderr = sys.stderr
+            sys.stderr = open(os.devnull, 'w')
+            try:
+                pool.remove('c')
+            finally:
+                sys.stderr.close()
+                sys.stderr = stderr
+            self.assertEqual(pool.keys, [''])
+            self.assertEqual(pool.acquire(), '')
+            # pools holding the same key share its budget
+            other = last.KeyPool(['a', 'd'], 2)
+            self.assertTrue(other.controller('a') is pool.controller('a'))
+            self.assertEqual(other.acquire(), 'd')
+        finally:
+            last.CONTROLLERS = controllers
+
+    def testsession(self):
+        """Test Session."""
+        xs = [last.TRACKS.add('/music/session/%d.mp3' % i) for i in range(20)]
+        for i, x in enumerate(xs):
+            last.TRACKS.settags(x, last.Track('Artist %d' % (i % 3),
+                                              'Title %d' % i,
+                                              playcount=i * 7 % 20))
+        best = sorted(xs, key=lambda x: last.TRACKS.tags(x).playcount,
+                      reverse=True)
+        a = last.Session(api='a, b', order='playcount', limit=5)
+        b = last.Session(api='b,a', order='reverse')
+        with last.using(a):
+            pool = last.keypool()
+            self.assertEqual(pool.keys, ['a', 'b'])
+        with last.using(last.Session(api='a,b')):
+            self.assertTrue(last.keypool() is pool)
+        with last.using(b):
+            self.assertTrue(last.keypool() is pool)
+        with last.using(last.Session(api='a')):
+            self.assertTrue(last.keypool().controller('a') is
+                            pool.controller('a'))
+        results = {}
+        def run(i):
+            session = (a, b)[i % 2]
+            results[i] = session.process([xs])
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(8):
+            self.assertEqual(results[i], best[:5] if i % 2 == 0 else xs[::-1])
+        self.assertTrue(last.current() is None)
+        self.assertTrue('playcount="19"' in a.write(best[:1]))
+        done = []
+        job = a.submit([xs], done.append)
+        self.assertEqual(job.get(5), best[:5])
+        self.assertEqual(done, [job])
+        job.then(done.append)
+        self.assertEqual(done, [job, job])
+        def fail(job):
+            raise RuntimeError('callback failed')
+        job = last.Job(a, [xs])
+        job.then(fail)
+        job.then(done.append)
+        stderr = sys.stderr
+        sys.stderr = open(os.devnull, 'w')
+        try:
+            job.run()
+        finally:
+            sys.stderr.close()
+            sys.stderr = stderr
+        self.assertEqual(job.get(), best[:5])
+        self.assertEqual(done[-1], job)
+
+    def testpause(self):
+        """Test that waiting for a key ends once the job is stopped."""
+        controllers = last.CONTROLLERS
+        last.CONTROLLERS = {}
+        try:
+            pool = last.KeyPool(['slow'], 0.1)
+            pool.acquire() # the next token comes in 10 seconds
+            job = last.Job(last.Session(), [])
+            threading.Timer(0.1, job.cancel).start()
+            start = time.time()
+            with last.using(None, job):
+                self.assertEqual(pool.acquire(), 'slow')
+            self.assertTrue(time.time() - start < 1)
+            job = last.Job(last.Session(), [], timeout=0.1)
+            start = time.time()
+            with last.using(None, job):
+                last.pause(10)
+            self.assertTrue(time.time() - start < 1)
+        finally:
+            last.CONTROLLERS = controllers
+
     def testrange(self):
         """Test subrange."""
         self.assertEqual(last.subrange([]),              (0, 0)) # []
@@ -193,5 +573,224 @@ class TestFunctions(unittest.TestCase):
                           'g9', 'h8', 'i7', 'j6', 'h9', 'i8', 'j7', 'k6', 'i9',
                           'j8', 'k7', 'l6', 'j9', 'k8', 'l7', 'k9', 'l8', 'l9'])
 
+class TestLastfm(unittest.TestCase):
+    def setUp(self):
+        self.server = lastserver.Server()
+        self.server.start()
+        self.urls = last.XMLURL, last.HTMLURL
+        last.XMLURL = self.server.url() + '2.0/?'
+        last.HTMLURL = self.server.url() + 'music/'
+
+    def tearDown(self):
+        self.server.stop()
+        last.XMLURL, last.HTMLURL = self.urls
+
+    def testlastfmxml(self):
+        """Test lastfmxml."""
+        listeners, playcount = lastserver.rating('A & B', 'C')
+        self.assertEqual(last.lastfmxml('A & B', 'C', api='key'),
+                         playcount)
+        self.assertEqual(last.lastfmxml('A & B', 'C', True, api='key'),
+                         listeners)
+        self.server.missing = 1
+        self.assertEqual(last.lastfmxml('A', 'C', api='key'), -1)
+        self.server.errors = 1
+        self.assertRaises(last.Unavailable,
+                          last.lastfmxml, 'A', 'C', api='key')
+        self.server.rate = 1
+        self.server.admit('key')
+        self.assertRaises(last.Throttled,
+                          last.lastfmxml, 'A', 'C', api='key')
+
+    def testlastfmhtml(self):
+        """Test lastfmhtml."""
+        listeners, playcount = lastserver.rating('A/B', 'C D')
+        self.assertEqual(last.lastfmhtml('A/B', 'C D'), playcount)
+        self.assertEqual(last.lastfmhtml('A/B', 'C D', True), listeners)
+        self.server.missing = 1
+        self.assertEqual(last.lastfmhtml('A', 'C'), -1)
+        self.server.errors = 1
+        self.assertRaises(last.Unavailable, last.lastfmhtml, 'A', 'C')
+        self.server.rate = 1
+        self.server.admit()
+        self.assertRaises(last.Throttled, last.lastfmhtml, 'A', 'C')
+
+    def testrefresher(self):
+        """Test Refresher."""
+        api, keys, controllers = last.API, last.KEYS, last.CONTROLLERS
+        last.API, last.KEYS, last.CONTROLLERS = 'key', {}, {}
+        try:
+            now = int(time.time())
+            xs = [last.TRACKS.add('/music/refresh/%d.mp3' % i)
+                  for i in range(4)]
+            last.TRACKS.settags(xs[0], last.Track('A', 'Old', playcount=1))
+            last.TRACKS.settags(xs[1], last.Track('a', 'old', playcount=1))
+            last.TRACKS.settags(xs[2], last.Track('A', 'New', playcount=1,
+                                                  fetched=now))
+            last.TRACKS.settags(xs[3], last.Track('A', 'Unrated'))
+            ratings = last.RATINGS.setdefault(last.lastfmplaycountrating, {})
+            ratings[xs[0]] = 1
+            done = []
+            lock = threading.Lock()
+            refresher = last.Refresher(xs, 60, lambda: done.append(True), 1,
+                                       lock)
+            with lock: # the ratings are not replaced while processing
+                refresher.start()
+                while not self.server.log:
+                    time.sleep(0.01)
+                time.sleep(0.1)
+                self.assertEqual(ratings.get(xs[0]), 1)
+                self.assertEqual(last.TRACKS.tags(xs[0]).playcount, 1)
+            refresher.join(5)
+            self.assertFalse(xs[0] in ratings)
+            playcount = lastserver.rating('A', 'Old')[1]
+            self.assertEqual([last.TRACKS.tags(x).playcount for x in xs],
+                             [playcount, playcount, 1, -1])
+            self.assertTrue(last.TRACKS.tags(xs[1]).fetched >= now)
+            self.assertEqual(len(self.server.log), 1)
+            self.assertEqual(done, [True])
+            self.assertEqual(refresher.changed, 1)
+        finally:
+            last.API, last.KEYS, last.CONTROLLERS = api, keys, controllers
+
+    def testrefresherworkers(self):
+        """Test refreshing with several workers at the full rate."""
+        api, keys, controllers = last.API, last.KEYS, last.CONTROLLERS
+        last.API, last.KEYS, last.CONTROLLERS = 'key', {}, {}
+        try:
+            self.server.latency = 0.5
+            xs = [last.TRACKS.add('/music/workers/%d.mp3' % i)
+                  for i in range(5)]
+            for i, x in enumerate(xs):
+                last.TRACKS.settags(x, last.Track('W', str(i), playcount=1))
+            refresher = last.Refresher(xs, 60, spare=1, workers=5)
+            start = time.time()
+            refresher.start()
+            refresher.join(5)
+            # paced at 5 per second, the requests overlap: one after the
+            # other, they would take 2.5 seconds on average
+            self.assertTrue(time.time() - start < 2)
+            self.assertEqual(len(self.server.log), 5)
+            self.assertEqual(refresher.changed, 5)
+        finally:
+            last.API, last.KEYS, last.CONTROLLERS = api, keys, controllers
+
+    def testinvalidkey(self):
+        """Test scraping the webpages once all keys are rejected."""
+        api, keys, controllers = last.API, last.KEYS, last.CONTROLLERS
+        last.API, last.KEYS, last.CONTROLLERS = 'key', {}, {}
+        stderr = sys.stderr
+        sys.stderr = open(os.devnull, 'w')
+        try:
+            last.keypool().remove('key')
+            listeners, playcount = lastserver.rating('A', 'B')
+            self.assertEqual(last.lastfmrequest(last.lastfmxml,
+                                                last.lastfmhtml, 'A', 'B'),
+                             playcount)
+            self.assertEqual(last.lastfmrequest(last.lastfmartistxml,
+                                                None, 'A'), -1)
+        finally:
+            sys.stderr.close()
+            sys.stderr = stderr
+            last.API, last.KEYS, last.CONTROLLERS = api, keys, controllers
+
+    def testoutage(self):
+        """Test that tracks are fetched again after an outage."""
+        api, keys, controllers = last.API, last.KEYS, last.CONTROLLERS
+        passes = last.PASSES
+        last.API, last.KEYS, last.CONTROLLERS = 'key', {}, {}
+        last.PASSES = 1
+        try:
+            xs = [last.TRACKS.add('/music/outage/%d.mp3' % i)
+                  for i in range(3)]
+            for i, x in enumerate(xs):
+                last.TRACKS.settags(x, last.Track('Outage', 'Title %d' % i))
+            session = last.Session(order='playcount')
+            self.server.errors = 1
+            self.assertEqual(sorted(session.process([xs])), sorted(xs))
+            self.assertFalse(any(x in last.RATINGS.get(
+                last.lastfmplaycountrating, {}) for x in xs))
+            self.server.errors = 0
+            last.KEYS, last.CONTROLLERS = {}, {} # close the circuit
+            log = len(self.server.log)
+            playcounts = [lastserver.rating('Outage', 'Title %d' % i)[1]
+                          for i in range(3)]
+            self.assertEqual(session.process([xs]),
+                             [x for p, x in sorted(zip(playcounts, xs),
+                                                   reverse=True)])
+            self.assertEqual(len(self.server.log) - log, 3)
+        finally:
+            last.API, last.KEYS, last.CONTROLLERS = api, keys, controllers
+            last.PASSES = passes
+
+    def testjob(self):
+        """Test Job."""
+        self.server.latency = 0.2
+        session = last.Session(api='key', order='playcount')
+        keys, controllers = last.KEYS, last.CONTROLLERS
+        last.KEYS, last.CONTROLLERS = {}, {}
+        try:
+            xs = [last.TRACKS.add('/music/job/%d.mp3' % i) for i in range(40)]
+            for i, x in enumerate(xs):
+                last.TRACKS.settags(x, last.Track('Job', 'Title %d' % i))
+            start = time.time()
+            job = session.submit([xs], timeout=0.5)
+            self.assertRaises(last.Cancelled, job.get, 5)
+            job = session.submit([xs])
+            time.sleep(0.2)
+            self.assertFalse(job.done())
+            job.cancel()
+            self.assertRaises(last.Cancelled, job.get, 5)
+            self.assertTrue(time.time() - start < 4)
+            self.assertTrue(len(self.server.log) < 20)
+        finally:
+            last.KEYS, last.CONTROLLERS = keys, controllers
+
+    def testcancel(self):
+        """Test that stopped jobs make no further requests."""
+        self.server.latency = 0.1
+        session = last.Session(api='key', order='playcount')
+        keys, controllers = last.KEYS, last.CONTROLLERS
+        passes = last.PASSES
+        last.KEYS, last.CONTROLLERS = {}, {}
+        last.PASSES = 3
+        try:
+            # lastfmrequest raises Cancelled without making a request
+            job = last.Job(session, [])
+            job.cancel()
+            with last.using(session, job):
+                self.assertRaises(last.Cancelled, last.lastfmrequest,
+                                  last.lastfmxml, last.lastfmhtml, 'A', 'C')
+            self.assertEqual(self.server.log, [])
+            # prefetch raises Cancelled instead of waiting for the
+            # circuit to close before the next pass
+            xs = [last.TRACKS.add('/music/cancel/%d.mp3' % i)
+                  for i in range(6)]
+            for i, x in enumerate(xs):
+                last.TRACKS.settags(x, last.Track('Cancel', 'Title %d' % i))
+            self.server.errors = 1
+            done = []
+            start = time.time()
+            job = session.submit([xs], done.append, timeout=1)
+            self.assertRaises(last.Cancelled, job.get, 5)
+            self.assertTrue(time.time() - start < 3)
+            self.assertEqual(done, [job])
+            self.assertTrue(isinstance(job.error, last.Cancelled))
+            log = len(self.server.log)
+            self.assertTrue(log <= len(xs))
+            # a job cancelled while waiting for a pass stops at once
+            self.server.errors = 0
+            job = session.submit([xs])
+            time.sleep(0.2)
+            self.assertFalse(job.done())
+            start = time.time()
+            job.cancel()
+            self.assertRaises(last.Cancelled, job.get, 1)
+            self.assertTrue(time.time() - start < 0.5)
+            self.assertEqual(len(self.server.log), log)
+        finally:
+            last.KEYS, last.CONTROLLERS = keys, controllers
+            last.PASSES = passes
+
 if __name__ == '__main__':
     unittest.main()